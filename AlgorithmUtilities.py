@@ -10,6 +10,13 @@
 ###############################
 
 import itertools
+import multiprocessing
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.optimize import milp, LinearConstraint, Bounds
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_bipartite_matching
 
 # DATA STRUCTURE CLASSES
 ########################
@@ -19,47 +26,103 @@ class Matching:
 	def __init__(self, options, students):
 		"""Create a new matching using the options and student name lists."""
 		
-		self.by_option = {option: set() for option in options}
-		self.by_student = {student: None for student in students}
-		#self.unhappy = set()
+		# Give every option and student an integer id, so that the matching
+		# itself can live in plain lists indexed by those ids
+		self.options = list(options)
+		self.students = list(students)
+		self.option_id = {option: j for j, option in enumerate(self.options)}
+		self.student_id = {student: i for i, student \
+			in enumerate(self.students)}
+		
+		# Option id matched to each student (-1 if none), and count per option
+		self.by_student = [-1] * len(self.students)
+		self.by_option_count = [0] * len(self.options)
+		
+		# Keep track of the options without any students as pairs come and go
+		self._underfilled = set(range(len(self.options)))
+		
+		# Also keep a tally of how many options have each number of students,
+		# which makes it cheap to track the biggest and smallest options
+		self._count_freq = [0] * (len(self.students) + 1)
+		self._count_freq[0] = len(self.options)
+		self._max_count = 0
+		self._min_count = 0
+	
+	def _pair_ids(self, u, v):
+		"""Return the (student id, option id) tuple for a pair of names given
+		either way round.
+		"""
+		
+		if u in self.option_id and v in self.student_id:
+			return self.student_id[v], self.option_id[u]
+		elif v in self.option_id and u in self.student_id:
+			return self.student_id[u], self.option_id[v]
+		else:
+			raise KeyError(repr((u, v)))
 	
 	def add_pair(self, u, v):
 		"""Add a new (student, option) pair to the matching."""
 		
 		# Figure out which way round the option and student were given
-		if u in self.by_option and v in self.by_student:
-			option, student = u, v
-		elif v in self.by_option and u in self.by_student:
-			option, student = v, u
-		else:
-			raise KeyError(repr((u, v)))
+		sid, oid = self._pair_ids(u, v)
 		
 		# Make sure the student isn't already matched to another option
-		if self.by_student[student] is None:
-			self.by_option[option].add(student)
-			self.by_student[student] = option
+		if self.by_student[sid] == -1:
+			self._add_by_id(sid, oid)
 		else:
 			message = "student {!r} has already been matched"
-			raise ValueError(message.format(student))
+			raise ValueError(message.format(self.students[sid]))
 	
 	def delete_pair(self, u, v):
 		"""Remove a particular (student, option) pair from the matching."""
 		
 		# Figure out which one is the option and which is the student
-		if u in self.by_option and v in self.by_student:
-			option, student = u, v
-		elif v in self.by_option and u in self.by_student:
-			option, student = v, u
-		else:
-			raise KeyError(repr((u, v)))
+		sid, oid = self._pair_ids(u, v)
 		
 		# Make sure that given the pair exists before trying to delete it
-		if self.by_student[student] == option:
-			self.by_option[option].remove(student)
-			self.by_student[student] = None
+		if self.by_student[sid] == oid:
+			self._del_by_id(sid, oid)
 		else:
 			message = "student {!r} is not matched to option {!r}"
-			raise ValueError(message.format(student, option))
+			raise ValueError(message.format(self.students[sid],
+				self.options[oid]))
+	
+	def _add_by_id(self, sid, oid):
+		"""Add a (student id, option id) pair to the matching, skipping all of
+		the checks. Only for callers that already know the pair is valid.
+		"""
+		
+		self.by_student[sid] = oid
+		self.by_option_count[oid] += 1
+		self._underfilled.discard(oid)
+		
+		# Move the option up one place in the tally of option sizes
+		new = self.by_option_count[oid]
+		self._count_freq[new - 1] -= 1
+		self._count_freq[new] += 1
+		if new > self._max_count:
+			self._max_count = new
+		if self._count_freq[self._min_count] == 0:
+			self._min_count += 1
+	
+	def _del_by_id(self, sid, oid):
+		"""Remove a (student id, option id) pair from the matching, skipping
+		all of the checks. Only for callers that know the pair is matched.
+		"""
+		
+		self.by_student[sid] = -1
+		self.by_option_count[oid] -= 1
+		if self.by_option_count[oid] == 0:
+			self._underfilled.add(oid)
+		
+		# Move the option down one place in the tally of option sizes
+		new = self.by_option_count[oid]
+		self._count_freq[new + 1] -= 1
+		self._count_freq[new] += 1
+		if new < self._min_count:
+			self._min_count = new
+		if self._count_freq[self._max_count] == 0:
+			self._max_count -= 1
 	
 	def obeys_max_per_option(self, max_per_option, option=None):
 		"""Return whether the given option has <= max_per_option students
@@ -68,13 +131,11 @@ class Matching:
 		
 		# If an option was given, then check that option
 		if option is not None:
-			return len(self.by_option[option]) <= max_per_option
+			count = self.by_option_count[self.option_id[option]]
+			return count <= max_per_option
 		
-		# Otherwise, check all of the options together
-		for assigned_students in self.by_option.values():
-			if len(assigned_students) > max_per_option:
-				return False
-		return True
+		# Otherwise, check the biggest option
+		return self._max_count <= max_per_option
 	
 	def obeys_min_per_option(self, min_per_option, option=None):
 		"""Return whether the given option has >= min_per_option students
@@ -83,93 +144,428 @@ class Matching:
 		
 		# If we got an option, check that one
 		if option is not None:
-			return len(self.by_option[option]) >= min_per_option
+			count = self.by_option_count[self.option_id[option]]
+			return count >= min_per_option
 		
-		# With no option given, check all of them together
-		for assigned_students in self.by_option.values():
-			if len(assigned_students) < min_per_option:
-				return False
-		return True
+		# With no option given, check the smallest option
+		return self._min_count >= min_per_option
 	
 	def as_tuples(self):
 		"""Return a frozen set of (student, option) tuples fully summarizing
 		the matching.
 		"""
 		
-		return frozenset(self.by_student.items())
-	
-	def clear(self):
-		"""Delete all pairs from the matching."""
-		
-		for student in self.by_student.keys():
-			self.by_student[student] = None
-		for option in self.by_option.keys():
-			self.by_option[option].clear()
+		return frozenset(self.to_names().items())
 	
-	def empty_options(self):
-		"""Return a set of the names of all options without any matched
-		students.
+	def to_names(self):
+		"""Return a dict giving the option name matched to each student name,
+		or None for unmatched students.
 		"""
 		
-		empty = set()
-		for option, assigned_students in self.by_option.items():
-			if len(assigned_students) == 0:
-				empty.add(option)
-		return empty
+		return {student: (self.options[oid] if oid != -1 else None) \
+			for student, oid in zip(self.students, self.by_student)}
 	
 	def lookup(self, u):
 		"""Return the students or the option that are matched with the given
 		option or student.
 		"""
 		
-		if u in self.by_student:
-			return self.by_student[u]
-		elif u in self.by_option:
-			return set(self.by_option[u])
+		if u in self.student_id:
+			oid = self.by_student[self.student_id[u]]
+			return self.options[oid] if oid != -1 else None
+		elif u in self.option_id:
+			oid = self.option_id[u]
+			return {student for student, matched \
+				in zip(self.students, self.by_student) if matched == oid}
 		else:
 			raise KeyError(repr(u))
 	
 	def underfilled(self, limit=1):
-		return {x for x, y in self.by_option.items() if len(y) < limit}
+		"""Return a set of the names of all options with fewer than limit
+		matched students.
+		"""
+		
+		# The usual limit of one is tracked as we go, so skip the full scan
+		if limit == 1:
+			return {self.options[oid] for oid in self._underfilled}
+		return {option for option, count \
+			in zip(self.options, self.by_option_count) if count < limit}
 
 class MatchingsIterator:
 	
-	def __init__(self, options, choices):
+	def __init__(self, options, choices, min_per_option, max_per_option):
 		""""""
 		
+		# Picks are stored as tuples, so nothing can change them mid-search
 		self.options = set(options)
-		self.choices = {name: list(picks) for name, picks in choices.items()}
+		self.choices = {name: tuple(picks) for name, picks in choices.items()}
+		
+		# Every matching yielded has min to max students in each option
+		self.min_per_option = min_per_option
+		self.max_per_option = max_per_option
+		
+		# Every search reuses this one matching, always undoing what it adds
+		self.match = Matching(self.options, students=self.choices.keys())
+		
+		# Sort the student names once here instead of at every recursion level
+		# Students with the most contested picks go first (fail first), so the
+		# search runs into the capacity limits near the top of the tree
+		popularity = {option: 0 for option in self.options}
+		for picks in self.choices.values():
+			for pick in picks:
+				popularity[pick] += 1
+		self._sorted_names = sorted(self.choices.keys(), key=lambda name: \
+			(-sum(popularity[pick] for pick in self.choices[name]), name))
+		self._n = len(self._sorted_names)
+		
+		# Look up the rank of any (student, pick) pair as the search goes
+		self._rank_of = {(name, pick): rank for name, picks \
+			in self.choices.items() for rank, pick in enumerate(picks)}
+		self._n_choices = max(len(picks) for picks in self.choices.values())
+		
+		# Packed score of the current matching, see ScoreCalculator.pack_score
+		# Weights and gains stay zero unless we're finding the best matchings
+		self._weights = (0,) * (1 + 2 * self._n_choices)
+		self._gain_of = {pair: 0 for pair in self._rank_of.keys()}
+		self._key = 0
+		
+		# Only used for pruning while searching for the best matchings
+		self._pruning = False
+		self._best_key = None
 	
 	def all_permitted_matchings(self, n_unhappy):
 		""""""
 		
-		self.match = Matching(self.options, students=self.choices.keys())
+		combos = itertools.combinations(self.choices.keys(), n_unhappy)
+		yield from self._iter_matchings(combos)
+	
+	def best_permitted_matchings(self, n_unhappy, scorer, processes=1):
+		"""Return the best (packed) score of any permitted matching with
+		n_unhappy unhappy students, along with the set of all matchings (as
+		tuples) that get that score. Branches that can't catch up to the best
+		score found so far are skipped. The score is None if no matchings were
+		found. With more than one process (or None for one per CPU), the sets
+		of unhappy students are split up into chunks and searched in parallel.
+		"""
+		
+		names = list(self.choices.keys())
+		combos = itertools.combinations(names, n_unhappy)
+		
+		if processes == 1:
+			best_key, best_matches = self._search(combos, scorer)
+		
+		else:
+			# Every worker gets its own copy of the inputs just once, up front
+			chunks = iter(lambda: list(itertools.islice(combos, 100)), [])
+			initargs = (self.options, self.choices, self.min_per_option,
+				self.max_per_option, scorer.high_priority)
+			best_key, best_matches = None, list()
+			pool = multiprocessing.Pool(processes, _init_worker, initargs)
+			with pool:
+				for key, matches in pool.imap_unordered(_search_chunk, chunks):
+					if key is None:
+						continue
+					if best_key is None or key > best_key:
+						best_key, best_matches = key, list()
+					if key == best_key:
+						best_matches.extend(matches)
+		
+		# Turn the best matchings into sets of (student, option) tuples at last
+		best_matches = {frozenset(zip(names, assigned)) \
+			for assigned in best_matches}
+		
+		return best_key, best_matches
+	
+	def _iter_matchings(self, unhappy_sets):
+		"""Yield every permitted matching for each of the given collections of
+		unhappy students in turn.
+		"""
+		
+		assert self.match.obeys_max_per_option(0)  # Should be empty here
+		
+		try:
+			for unhappy in unhappy_sets:
+				
+				self.unhappy = set(unhappy)
+				yield from self._iter_recurse()
+		
+		finally:
+			# Searches that get stopped early leave pairs behind, start over
+			if not self.match.obeys_max_per_option(0):
+				self.match = Matching(self.options, self.choices.keys())
+	
+	def _search(self, unhappy_sets, scorer):
+		"""Return the best packed score of any permitted matching for the given
+		collections of unhappy students, along with a list of the matchings
+		that get it, each one a tuple of options in student order.
+		"""
+		
+		# Work out how much each (student, pick) pair adds to the packed score
+		w, nc = scorer.weights, self._n_choices
+		hp = scorer.high_priority
+		self._weights = w
+		self._gain_of = {(name, pick): w[1 + rank] + \
+			(w[1 + nc + rank] if hp[name] else 0) \
+			for (name, pick), rank in self._rank_of.items()}
+		
+		self._pruning = True
+		self._best_key = None
+		best_matches = list()
+		
+		try:
+			for match in self._iter_matchings(unhappy_sets):
+				
+				# The search keeps the packed score up to date, so compare it
+				key = self._key
+				if self._best_key is not None and key < self._best_key:
+					continue
+				
+				# Just copy the option ids for now, it's cheaper than building
+				# the frozen set of pairs for every tie
+				if None in (match.lookup(name) for name in self.unhappy):
+					raise ValueError("scoring an incomplete match")
+				if key != self._best_key:
+					best_matches = list()
+					self._best_key = key
+				best_matches.append(tuple(match.by_student))
+		finally:
+			self._weights = (0,) * (1 + 2 * nc)
+			self._gain_of = {pair: 0 for pair in self._rank_of.keys()}
+			self._pruning = False
+		
+		# Option names travel between processes better than the ids do
+		options = self.match.options
+		best_matches = [tuple(options[oid] for oid in assigned) \
+			for assigned in best_matches]
+		
+		return self._best_key, best_matches
+	
+	def find_best(self, scorer, n_unhappy=None):
+		"""Return the best score and set of best matchings (as tuples) with as
+		few unhappy students as possible, starting the search at n_unhappy of
+		them and adding one more until some permitted matchings are found. By
+		default, start from the lower bound given by min_unhappy_students().
+		"""
+		
+		if n_unhappy is None:
+			n_unhappy = min_unhappy_students(self.options, self.choices,
+				self.min_per_option, self.max_per_option)
+		
+		while n_unhappy <= self._n:
+			best_score, best_matches = \
+				self.best_permitted_matchings(n_unhappy, scorer)
+			if best_score is not None:
+				return best_score, best_matches
+			n_unhappy += 1
+		
+		return None, set()
+	
+	def _iter_recurse(self):
+		"""Walk depth first through every permitted way of giving the happy
+		students one of their picks, yielding the matching at each leaf. Uses
+		an explicit stack of pick positions instead of recursive generators.
+		"""
+		
+		# Unhappy students don't get a level, they are handled at the leaves
+		names = [name for name in self._sorted_names \
+			if name not in self.unhappy]
+		gains = [[self._gain_of[name, pick] for pick in self.choices[name]] \
+			for name in names]
+		depth = len(names)
+		
+		# Work with student and option ids in the loop to skip name lookups
+		match = self.match
+		max_per_option = self.max_per_option
+		sids = [match.student_id[name] for name in names]
+		pick_ids = [[match.option_id[pick] for pick in self.choices[name]] \
+			for name in names]
+		counts = match.by_option_count
+		
+		# Best case for each level and all the levels below is all first picks
+		best_left = [sum(g[0] for g in gains[level:]) \
+			for level in range(depth + 1)]
 		
-		for unhappy in itertools.combinations(self.choices.keys(), n_unhappy):
+		# Start the score off with all of the happy students, then add ranks
+		self._key = depth * self._weights[0]
+		
+		# At each level, the number of picks already tried for that student
+		tried = [0] * depth
+		level = 0
+		
+		# Different picks higher up can leave the same counts per option at
+		# some level, and everything below only depends on that state, so
+		# remember an upper bound on how much score each state can still add
+		memo = dict()
+		states = [None] * depth
+		entry_key = [0] * depth
+		best_below = [None] * depth  # Best (bound on) leaf key in subtree
+		
+		def leave(level):
+			"""Remember what the subtree at this level could score, and pass
+			it up to the level above.
+			"""
+			best = best_below[level]
+			if best is None:
+				memo[states[level]] = float("-inf")  # No leaves down there
+				return
+			memo[states[level]] = best - entry_key[level]
+			if level > 0 and (best_below[level - 1] is None \
+				or best > best_below[level - 1]):
+				best_below[level - 1] = best
+		
+		while level >= 0:
+			
+			if level == depth:
+				# Unhappy students who land on one of their own picks still add
+				# to the score, so only placements that add the same amount are
+				# interchangeable, yield one matching for each different amount
+				# (no placements at all if the minimum per option can't be met)
+				for placement, lucky in self._unhappy_placements():
+					pairs = [(match.student_id[n], match.option_id[e]) \
+						for n, e in placement]
+					for sid, oid in pairs:
+						match._add_by_id(sid, oid)
+					self._key += lucky
+					yield match
+					if self._pruning and level > 0 and (best_below[level - 1] \
+						is None or self._key > best_below[level - 1]):
+						best_below[level - 1] = self._key
+					self._key -= lucky
+					for sid, oid in pairs:
+						match._del_by_id(sid, oid)
+				level -= 1
+				continue
+			
+			sid = sids[level]
+			picks = pick_ids[level]
+			
+			if tried[level] > 0:
+				# Coming back up to this level, so undo the last pick made here
+				rank = tried[level] - 1
+				match._del_by_id(sid, picks[rank])
+				self._key -= gains[level][rank]
+			elif self._pruning:
+				states[level] = (level, tuple(counts))
+				entry_key[level] = self._key
+				best_below[level] = None
+				
+				# Give up on this branch if even the best case can't keep up
+				# Ties are still explored so we find all of the best matchings
+				if self._best_key is not None:
+					if states[level] in memo:
+						bound = self._key + memo[states[level]]
+					else:
+						bound = self._key + best_left[level] + \
+							self._lucky_bound()
+					if bound < self._best_key:
+						best_below[level] = bound
+						leave(level)
+						level -= 1
+						continue
+			
+			# Out of picks for this student, so backtrack to the level above
+			if tried[level] == len(picks):
+				tried[level] = 0
+				if self._pruning:
+					leave(level)
+				level -= 1
+				continue
 			
-			self.unhappy = set(unhappy)
-			yield from self._iter_recurse()
+			# Picks are tried best rank first, so good matchings show up early
+			rank = tried[level]
+			pick = picks[rank]
+			tried[level] += 1
+			match._add_by_id(sid, pick)
+			self._key += gains[level][rank]
+			if counts[pick] <= max_per_option:
+				level += 1
 	
-	def _iter_recurse(self, index=0):
+	def _unhappy_placements(self):
+		"""Return a list of (pairs, lucky gain) tuples, each one a way to put
+		the unhappy students into the open spots that brings every option up
+		to the minimum, along with how much it adds to the packed score (see
+		_lucky_gain). Only the first way found for each gain is kept.
+		"""
 		
-		if index == len(self.choices):
-			for perm in itertools.permutations(self.unhappy):
-				for n, e in zip(perm, self.match.underfilled()):
-					self.match.add_pair(n, e)
-				yield self.match
-				for n, e in zip(perm, self.match.underfilled()):
-					self.match.delete_pair(n, e)
+		match = self.match
+		unhappy = sorted(self.unhappy)
+		room = {option: self.max_per_option - count for option, count \
+			in zip(match.options, match.by_option_count)}
+		keep = self.max_per_option - self.min_per_option  # Room left at min
+		placements = dict()
 		
-		else:
-			name = sorted(self.choices.keys())[index]
-			if name in self.unhappy:
-				yield from self._iter_recurse(index + 1)
-			else:
-				for pick in self.choices[name]:
-					self.match.add_pair(name, pick)
-					if self.match.obeys_max_per_option(2, pick):
-						yield from self._iter_recurse(index + 1)
-					self.match.delete_pair(name, pick)
+		def short():
+			"""Return how many students the options still need for the
+			minimum.
+			"""
+			return sum(r - keep for r in room.values() if r > keep)
+		
+		def place_others(others, pairs):
+			"""Put each of the others somewhere that isn't one of their picks,
+			neediest options first, and return all the pairs (or None if the
+			minimum can't be met that way).
+			"""
+			if short() > len(others):
+				return None
+			if not others:
+				return pairs
+			name = others[0]
+			for option in sorted(room.keys(), key=lambda x: (-room[x], x)):
+				if room[option] > 0 and option not in self.choices[name]:
+					room[option] -= 1
+					found = place_others(others[1:], pairs + [(name, option)])
+					room[option] += 1
+					if found is not None:
+						return found
+			return None
+		
+		def place(i, pairs, lucky, others):
+			"""Try each unhappy student on each of their picks with room, or
+			set them aside with the others, who all add nothing wherever
+			they end up.
+			"""
+			if short() > len(unhappy) - i + len(others):
+				return
+			if i == len(unhappy):
+				if lucky not in placements:
+					found = place_others(others, pairs)
+					if found is not None:
+						placements[lucky] = found
+				return
+			name = unhappy[i]
+			for pick in self.choices[name]:
+				if room[pick] > 0:
+					room[pick] -= 1
+					place(i + 1, pairs + [(name, pick)],
+						lucky + self._lucky_gain([(name, pick)]), others)
+					room[pick] += 1
+			place(i + 1, pairs, lucky, others + [name])
+		
+		place(0, list(), 0, list())
+		return [(pairs, lucky) for lucky, pairs in placements.items()]
+	
+	def _lucky_gain(self, pairs):
+		"""Return how much the packed score goes up from the given (unhappy
+		student, open option) pairs where the option was one of their picks.
+		"""
+		
+		lucky = 0
+		for pair in pairs:
+			if pair in self._gain_of:
+				lucky += self._weights[0] + self._gain_of[pair]
+		return lucky
+	
+	def _lucky_bound(self):
+		"""Return the most that unhappy students could add to the packed score
+		by landing on one of their picks that still has room.
+		"""
+		
+		open_options = self.match.underfilled(self.max_per_option)
+		bound = 0
+		for name in self.unhappy:
+			bound += max((self._lucky_gain([(name, e)]) for e in open_options),
+				default=0)
+		return bound
 
 class ScoreCalculator:
 	
@@ -184,56 +580,254 @@ class ScoreCalculator:
 			raise TypeError("choice list lengths mismatch")
 		self.n_choices = lengths.pop()
 		
-		self.choices = {name: list(picks) for name, picks in choices.items()}
+		# Picks are stored as tuples, since the scorer never changes them
+		self.choices = {name: tuple(picks) for name, picks in choices.items()}
 		self.high_priority = {name: hp for name, hp in high_priority.items()}
+		
+		# Scores get packed into one int with a few bits per component, since
+		# no component can be bigger than the number of students
+		self._score_len = 1 + 2 * self.n_choices
+		self._bits = len(self.choices).bit_length()
+		self.weights = tuple(1 << (self._bits * (self._score_len - 1 - i)) \
+			for i in range(self._score_len))
+		
+		# Give the students a fixed order so scoring can go by index, with the
+		# packed score gained for each pick looked up directly
+		w, nc = self.weights, self.n_choices
+		self._students = list(self.choices.keys())
+		self._gains = [{pick: w[0] + w[1 + rank] + \
+			(w[1 + nc + rank] if self.high_priority[name] else 0) \
+			for rank, pick in enumerate(self.choices[name])} \
+			for name in self._students]
 	
 	def calculate_score(self, match):
-		""""""
+		"""Return the score of a complete match, packed into a single int
+		(see pack_score) so that scores compare with one integer comparison.
+		"""
 		
-		score = list()
+		score = 0
 		
-		score.append(len(self.choices))  # Number of happy students
-		for i in range(self.n_choices * 2):
-			score.append(0)
+		# Read option ids right off the matching if it uses our student order
+		if match.students == self._students:
+			assigned_ids = match.by_student
+		else:
+			assigned_ids = [match.by_student[match.student_id[name]] \
+				for name in self._students]
 		
-		for name, picks in self.choices.items():
+		for i, oid in enumerate(assigned_ids):
 			
-			assigned = match.lookup(name)
-			hp = self.high_priority[name]
-			
-			if assigned is None:
+			if oid == -1:
 				raise ValueError("scoring an incomplete match")
 			
-			try:
-				rank = picks.index(assigned)
-			except ValueError:
-				rank = None
-			
-			if rank is not None:
-				score[1 + rank] += 1
-				if hp:
-					score[1 + self.n_choices + rank] += 1
-			else:
-				score[0] -= 1
+			# Unhappy students don't add anything to the score at all
+			score += self._gains[i].get(match.options[oid], 0)
+		
+		return score
+	
+	def pack_score(self, score):
+		"""Return a single int that compares the same way as the score tuple
+		does, which is handy for comparing lots of scores quickly.
+		"""
+		
+		return sum(s * w for s, w in zip(score, self.weights))
+	
+	def unpack_score(self, key):
+		"""Return the score tuple that was packed into the given int."""
 		
-		return tuple(score)
+		mask = (1 << self._bits) - 1
+		return tuple((key // w) & mask for w in self.weights)
 	
 	def interpret_score(self, score):
-		""""""
+		"""Return a readable summary of a packed score."""
+		
+		score = self.unpack_score(score)
+		nc = self.n_choices
 		
 		s0 = "{:d}/{:d} happy students".format(score[0], len(self.choices))
 		
 		x1 = ["{:d} students got their choice #{:d}".format(score[i], i) \
-			for i in range(1, 1 + self.n_choices)]
-		x2 = ["{:d} hp students got their choice #{:d}".format(score[i], i) \
-			for i in range(1 + self.n_choices, 1 + 2 * self.n_choices)]
+			for i in range(1, 1 + nc)]
+		x2 = ["{:d} hp students got their choice #{:d}".format(score[i], \
+			i - nc) for i in range(1 + nc, 1 + 2 * nc)]
 		
 		return '\n'.join([s0] + x1 + x2)
 
 # ALGORITHM SUBROUTINES
 #######################
 
+def rank_maximal_matching(options, choices, high_priority, min_per_option,
+	max_per_option):
+	"""Return a best Matching according to the ScoreCalculator priorities,
+	solved by rank_maximal_assignment() below.
+	"""
+	
+	options = list(options)
+	names = list(choices.keys())
+	option_id = {option: j for j, option in enumerate(options)}
+	
+	# The solver works on option indices, in the same student order as names
+	picks = [tuple(option_id[pick] for pick in choices[name])
+		for name in names]
+	assigned = rank_maximal_assignment(picks,
+		[high_priority[name] for name in names], len(options), min_per_option,
+		max_per_option)
+	
+	match = Matching(options, names)
+	for name, j in zip(names, assigned):
+		match.add_pair(name, options[j])
+	
+	return match
+
+def rank_maximal_assignment(choices, high_priority, n_options,
+	min_per_option, max_per_option):
+	"""Return a list with the best option index for each student, given each
+	student's ranked choices as option indices and their high priority flag.
+	The best assignment maximizes the score tuple (happy students, 1st
+	choices, 2nd choices, ..., then the same for high priority students)
+	lexicographically, giving every option min to max students. This is
+	exact for any class size. Raise ValueError if the limits can't be met.
+	"""
+	
+	n_students = len(choices)
+	n_choices = len(choices[0])
+	n_score = 1 + 2 * n_choices  # Same layout as ScoreCalculator scores
+	
+	# Neither solver below can be trusted to notice impossible limits, so
+	# check them up front (the Hungarian one would just leave students out)
+	if not n_options * min_per_option <= n_students:
+		raise ValueError("not enough students to meet the minimum per option")
+	if not n_students <= n_options * max_per_option:
+		raise ValueError("too many students to obey the maximum per option")
+	
+	# Give one unit of each score component a weight that beats any number of
+	# units from all the components after it, so the sum keeps the tuple order
+	base = n_students + 1  # No score component can ever reach this value
+	weight = [base ** (n_score - 1 - k) for k in range(n_score)]
+	
+	# Filling a seat needed for the per-option minimum outweighs any score
+	min_seat_bonus = base ** n_score
+	
+	# Those weights blow up fast, and the solver works in float64, which only
+	# holds whole numbers exactly up to 2**53, so check with Python ints first
+	# Keep some headroom, the solver adds up costs along augmenting paths
+	largest = 2 * n_students * (min_seat_bonus + sum(weight))
+	if largest >= 2 ** 53:
+		return _lexicographic_milp(choices, high_priority, n_options,
+			min_per_option, max_per_option)
+	
+	# Each option gets max_per_option columns, one "seat" per column
+	# The first min_per_option seats of every option are the required ones
+	cost = np.zeros((n_students, n_options * max_per_option))
+	for j in range(n_options):
+		start = j * max_per_option
+		cost[:, start:start + min_per_option] -= min_seat_bonus
+	for i, picks in enumerate(choices):
+		for rank, pick in enumerate(picks):
+			gain = weight[0] + weight[1 + rank]
+			if high_priority[i]:
+				gain += weight[1 + n_choices + rank]
+			start = pick * max_per_option
+			cost[i, start:start + max_per_option] -= gain
+	
+	# Let the Hungarian algorithm do the heavy lifting, then read off seats
+	rows, cols = linear_sum_assignment(cost)
+	assigned = [-1] * n_students
+	for i, j in zip(rows, cols):
+		assigned[i] = int(j) // max_per_option
+	
+	return assigned
 
+def _lexicographic_milp(choices, high_priority, n_options, min_per_option,
+	max_per_option):
+	"""Solve the same problem as rank_maximal_assignment() one score
+	component at a time with scipy's milp(), holding on to the best value of
+	each component while optimizing the next. No weights needed at all.
+	"""
+	
+	n_students = len(choices)
+	n_choices = len(choices[0])
+	n_vars = n_students * n_options  # Variable i * n_options + j is i to j
+	
+	# Every student gets exactly one option, every option gets min to max
+	rows = np.zeros((n_students + n_options, n_vars))
+	for i in range(n_students):
+		rows[i, i * n_options:(i + 1) * n_options] = 1
+	for j in range(n_options):
+		rows[n_students + j, j::n_options] = 1
+	lower = [1] * n_students + [min_per_option] * n_options
+	upper = [1] * n_students + [max_per_option] * n_options
+	constraints = [LinearConstraint(rows, lower, upper)]
+	
+	# One row of coefficients for each component of the score tuple
+	components = np.zeros((1 + 2 * n_choices, n_vars))
+	for i, picks in enumerate(choices):
+		for rank, pick in enumerate(picks):
+			components[0, i * n_options + pick] = 1
+			components[1 + rank, i * n_options + pick] = 1
+			if high_priority[i]:
+				components[1 + n_choices + rank, i * n_options + pick] = 1
+	
+	integrality = np.ones(n_vars)
+	bounds = Bounds(0, 1)
+	for component in components:
+		if not component.any():
+			continue  # Nothing to optimize, e.g. no high priority students
+		result = milp(-component, constraints=constraints,
+			integrality=integrality, bounds=bounds)
+		if result.status != 0:
+			raise RuntimeError("milp() failed: " + result.message)
+		
+		# The sums are whole numbers, the half just absorbs rounding error
+		best = round(-result.fun)
+		constraints.append(LinearConstraint(component, best - 0.5, np.inf))
+	
+	chosen = result.x.reshape((n_students, n_options)) > 0.5
+	return [int(j) for j in chosen.argmax(axis=1)]
+
+# Each worker process searches with its own iterator, see _init_worker()
+_worker = dict()
+
+def _init_worker(options, choices, min_per_option, max_per_option,
+	high_priority):
+	"""Set up the iterator and scorer for a worker process to use."""
+	
+	_worker["iterator"] = MatchingsIterator(options, choices, min_per_option,
+		max_per_option)
+	_worker["scorer"] = ScoreCalculator(choices, high_priority)
+
+def _search_chunk(unhappy_sets):
+	"""Search one chunk of unhappy student sets inside a worker process."""
+	
+	return _worker["iterator"]._search(unhappy_sets, _worker["scorer"])
+
+def min_unhappy_students(options, choices, min_per_option, max_per_option):
+	"""Return a lower bound on the number of unhappy students in any
+	matching, using a maximum bipartite matching between students and the
+	seats of the options they picked. Options that nobody picked at all will
+	each need min_per_option unhappy students too.
+	"""
+	
+	options = list(options)
+	names = list(choices.keys())
+	option_id = {option: j for j, option in enumerate(options)}
+	
+	# Connect each student to every seat of every option that they picked
+	rows, cols = list(), list()
+	for i, name in enumerate(names):
+		for pick in choices[name]:
+			start = option_id[pick] * max_per_option
+			for j in range(start, start + max_per_option):
+				rows.append(i)
+				cols.append(j)
+	graph = csr_matrix((np.ones(len(rows)), (rows, cols)),
+		shape=(len(names), len(options) * max_per_option))
+	
+	# Students left without a seat can't all be made happy at the same time
+	seats = maximum_bipartite_matching(graph, perm_type='column')
+	max_happy = int(np.count_nonzero(seats != -1))
+	unpicked = set(options).difference(*choices.values())
+	
+	return max(len(names) - max_happy, len(unpicked) * min_per_option)
 
 # ALGORITHM-ADJACENT FUNCTIONS
 ##############################
@@ -17,6 +17,18 @@
 # Max students per geologic period might need to be increased to 3 sometimes
 
 # CURRENT STRATEGY:
+# Go back to the Nov 2020 strategy below, it was the right idea all along
+# Every option gets MAX_PER_OPTION "seats", i.e. columns of the cost matrix
+# Score components get weights in powers of (n_students + 1), so the cost of
+# a matching sorts exactly like the score tuple does (priorities 2-6 below)
+# The first MIN_PER_OPTION seats of each option get a bonus bigger than any
+# score, which means the solver fills them first (priority 1 below)
+# Those weights only stay exact in float64 while they're below 2**53, so for
+# bigger classes it maximizes one score component at a time with milp instead
+# The brute-force MatchingsIterator is still around for checking results, see
+# CheckMatchings.py, which compares the two on lots of small random classes
+
+# OLD STRATEGY FROM DEC 2020:
 # REPEATED RANDOM SERIAL DICTATORSHIP!!!
 # or........
 # Optimize for only one factor at a time, prioritizing factors like so:
@@ -60,9 +72,8 @@
 # SETUP CODE AND CONSTANTS
 ##########################
 
+import csv  # For reading the spreadsheet of student choices
 import json  # For pretty printing of dict objects
-#import numpy as np
-#from scipy.optimize import linear_sum_assignment
 #import pandas  # For reading an XLSX file if needed
 import random
 
@@ -83,26 +94,31 @@ MAX_PER_OPTION = 2  # Maximum number of students assigned per geologic period
 ######################
 
 # Read the list of options (geologic periods) from file
+options, seen_options = list(), set()
 with open(OPTIONS_FILE, "r") as options_f:
-	options = [line.strip() for line in options_f if line.strip() != ""]
+	for line in options_f:
+		option = line.strip()
+		if not option:
+			continue  # Skip any lines that are blank
+		assert option not in seen_options  # Make sure options are all unique
+		seen_options.add(option)
+		options.append(option)
 
 # Sanity checks on the options data
-assert len(options) == len(set(options))  # Make sure options are all unique
 assert len(options) == N_OPTIONS  # Check for the right number of options
+options_set = frozenset(options)  # For quick membership checks below
 
 # Read the student choices (and high priority status) info from file
 choices, high_priority = dict(), dict()
 column_headers = ["Student Name", "High Priority"]
 column_headers.extend(["Choice {:d}".format(n+1) for n in range(N_CHOICES)])
 n_columns = len(column_headers)
-header_line = ','.join(column_headers) + '\n'
-with open(CHOICES_FILE, 'r') as choices_f:
-	assert choices_f.readline() == header_line
-	for line in choices_f:
-		row = line.strip()
-		if not row:
+with open(CHOICES_FILE, 'r', newline='') as choices_f:
+	reader = csv.reader(choices_f)
+	assert next(reader) == column_headers
+	for columns in reader:
+		if not columns:
 			continue  # Skip any lines that are blank
-		columns = row.split(',')
 		assert len(columns) == n_columns
 		name = columns[0]
 		assert name not in high_priority  # Make sure names are unique
@@ -110,7 +126,7 @@ with open(CHOICES_FILE, 'r') as choices_f:
 		assert name not in choices  # Make sure names are unique
 		choices[name] = list()
 		for my_choice in columns[2:]:
-			assert my_choice in options
+			assert my_choice in options_set
 			assert my_choice not in choices[name]  # Must pick distinct choices
 			choices[name].append(my_choice)
 		assert len(choices[name]) == N_CHOICES
@@ -136,64 +152,38 @@ for choice_list in choices.values():
 print("First choices:", first_choices, sep='\n')
 print("All top choices:", all_choices, sep='\n')
 
+# Work out how many students can't possibly get any of their choices
+n_unhappy_min = au.min_unhappy_students(options, choices, MIN_PER_OPTION,
+	MAX_PER_OPTION)
+print("At least", n_unhappy_min, "students will be unhappy")
+
 # SETUP INITIALIZATIONS FOR THE ALGORITHM
 #########################################
 
-match_iter = au.MatchingsIterator(options, choices)
-#match_iter.set_min_and_max()
-
-n_unhappy_students = 1 # calculate minimum limit
-
 scorer = au.ScoreCalculator(choices, high_priority)
 
-best_matches = None
-best_score = None
-
 # RUNNING THE ACTUAL ALGORITHM
 ##############################
 
-while True:
-	
-	for match in match_iter.all_permitted_matchings(n_unhappy_students):
-		score = scorer.calculate_score(match)
-		if best_matches is None or score > best_score:
-			best_matches = set()
-			best_matches.add(match.as_tuples())
-			best_score = score
-		elif score == best_score:
-			best_matches.add(match.as_tuples())
-	
-	if best_matches is None:
-		n_unhappy_students += 1
-	else:
-		break
+best_match = au.rank_maximal_matching(options, choices, high_priority,
+	MIN_PER_OPTION, MAX_PER_OPTION)
+best_score = scorer.calculate_score(best_match)
 
 # REPORTING ON THE RESULTS
 ##########################
 
 print(scorer.interpret_score(best_score))
 
-'''
-if type(bestmatch) is type(frozenset()):
-	bestmatch = {bestmatch}
-
-print("Found", len(bestmatch), "alternate best matchings")
-
-for i, match in enumerate(bestmatch):
-	
-	print("MATCHING", i + 1)
-	
-	for option in options:
-		print(" ", option)
-		for name, assignment in match:
-			if assignment == option:
-				try:
-					rank = choices[name].index(assignment)
-					rank = "(choice #" + str(rank + 1) + ")"
-				except ValueError:
-					rank = "(unhappy)"
-				print("   ", name, rank)
-'''
+print("BEST MATCHING")
+for option in options:
+	print(" ", option)
+	for name in sorted(best_match.lookup(option)):
+		try:
+			rank = choices[name].index(option)
+			rank = "(choice #" + str(rank + 1) + ")"
+		except ValueError:
+			rank = "(unhappy)"
+		print("   ", name, rank)
 
 # WRITING RESULTS OUT TO FILE
 #############################
@@ -24,7 +24,17 @@
 #  3. Prioritize choices of HP students, all else being equal
 # Those first couple priorities are actually decently restrictive conditions
 # A really good algorithm would exploit those restrictions to its advantage
-# 
+# The Hungarian algorithm from Nov 2020 turns out to handle all of this fine
+#  Give every option max_per_option "seats" (columns of the cost matrix)
+#  Weight each score component by powers of (n_students + 1), most important
+#  first, so the total cost sorts exactly like the score tuple does
+#  The seats needed for min_per_option get a bonus that beats any score
+#  The weights only stay exact in float64 below 2**53, so bigger classes get
+#  solved one score component at a time with scipy's milp() instead
+# OR-Tools' CP-SAT solver can also solve the same problem, with the min and
+#  max as hard constraints, set ALGORITHM to "cpsat" for it
+#  It maximizes one score component at a time instead of using weights
+# The recursive algorithm is still here, set ALGORITHM to "recursive" for it
 
 # OLD STRATEGY FROM DEC 2020:
 # REPEATED RANDOM SERIAL DICTATORSHIP!!! (with scoring as below)
@@ -73,9 +83,12 @@
 import pandas as pd  # Uses the xlrd package to read MS Excel files
 import re
 import math
+import collections
 import itertools as it
 import random
 
+import AlgorithmUtilities as au
+
 # CONSTANTS
 #############
 
@@ -86,6 +99,13 @@ STUDENTS_FILE = "FakeChoices.csv"  # Student choices and high priorities
 OUTPUT_FILE = "Assignments.txt"  # Final student assignments from algorithm
 
 # Parameters for the matching algorithm
+ALGORITHM = "hungarian"  # Pick from "hungarian", "cpsat", or "recursive"
+
+# Regular expressions to try and match the students file column headers
+NAME_RE = re.compile(r"(\A|\s+)NAME(\Z|\s+)", re.IGNORECASE)
+HP_RE = re.compile(r"(\A|\s+)PRIORITY(\Z|\s+)", re.IGNORECASE)
+CHOICE_RE = re.compile(r"(\A|\s+)CHOICE(\Z|\s+)", re.IGNORECASE)
+NUMBER_RE = re.compile(r"\A[^\d]*(\d+)[^\d]*\Z")  # Rank in a choice header
 
 
 # MAIN FUNCTION
@@ -100,7 +120,7 @@ def main():
 	
 	# Determine a few other important numbers from the data
 	n_options = len(options)
-	n_students = len(students)
+	n_students = len(students.names)
 	min_per_option = math.floor(n_students / n_options)  # Can change this
 	max_per_option = math.ceil(n_students / n_options)  # Can change this
 	
@@ -108,12 +128,31 @@ def main():
 	assert min_per_option * n_options <= n_students, "cannot satisfy minimum"
 	assert max_per_option * n_options >= n_students, "cannot satisfy maximum"
 	
+	# Look up which rank each student gave each option once, up front
+	rank = make_rank_table(students, n_options, n_choices)
+	
 	# Set up the mutable matching data structure for the algorithm
 	match = Matching(students, options)
 	
-	# Run the recursive algorithm to find the best student-option pairings
-	best_pairings, best_score = recursive_assignment_algorithm(match, students,
-		options, n_choices, min_per_option, max_per_option)
+	# Run the chosen algorithm to find the best student-option pairings
+	if ALGORITHM == "hungarian":
+		best_pairings, best_score = hungarian_assignment_algorithm(match,
+			students, options, n_choices, rank, min_per_option, max_per_option)
+	elif ALGORITHM == "cpsat":
+		best_pairings, best_score = cpsat_assignment_algorithm(match,
+			students, options, n_choices, rank, min_per_option, max_per_option)
+	elif ALGORITHM == "recursive":
+		# The search does better meeting the hardest students first, so give it
+		# a reordered copy of the students and map its pairs back afterwards
+		search_students, order = sort_students_for_search(students, n_options)
+		search_rank = make_rank_table(search_students, n_options, n_choices)
+		search_match = Matching(search_students, options)
+		search_pairings, best_score = recursive_assignment_algorithm(
+			search_match, search_students, options, n_choices, search_rank,
+			min_per_option, max_per_option)
+		best_pairings = [(order[s], option) for s, option in search_pairings]
+	else:
+		raise ValueError("unknown algorithm: {!r}".format(ALGORITHM))
 	
 	# Clear the matching data structure and fill it with the best matches
 	match.erase_all()
@@ -122,7 +161,7 @@ def main():
 	# Print the score of the best matching and the matching itself
 	print("Score of best matching:", best_score)
 	print("Best matching:")
-	match.pretty_print_in_order(options, students, n_choices)
+	match.pretty_print_in_order(options, students, rank)
 
 # SUBROUTINES
 ###############
@@ -134,7 +173,7 @@ def read_options(options_file_name):
 	
 	# Read options from TXT file, expecting one per non-blank line
 	with open(options_file_name, 'r') as options_file:
-		options = [line.strip() for line in options_file if line.strip() != ""]
+		options = [line for line in map(str.strip, options_file) if line]
 	
 	# Return the list of options as long as they are all unique
 	assert len(options) == len(set(options)), "options must all be unique"
@@ -151,16 +190,11 @@ def read_student_data(students_file_name, options_list):
 	else:
 		raise TypeError("unsupported students data file format")
 	
-	# Regular expressions to try and match the column headers
-	name_re = re.compile(r"(\A|\s+)NAME(\Z|\s+)", re.IGNORECASE)
-	hp_re = re.compile(r"(\A|\s+)PRIORITY(\Z|\s+)", re.IGNORECASE)
-	choice_re = re.compile(r"(\A|\s+)CHOICE(\Z|\s+)", re.IGNORECASE)
-	
 	# Identify the columns in the spreadsheet using the REs
 	columns = df.columns.tolist()
-	name_matches = [col for col in columns if name_re.search(col)]
-	hp_matches = [col for col in columns if hp_re.search(col)]
-	choice_matches = [col for col in columns if choice_re.search(col)]
+	name_matches = [col for col in columns if NAME_RE.search(col)]
+	hp_matches = [col for col in columns if HP_RE.search(col)]
+	choice_matches = [col for col in columns if CHOICE_RE.search(col)]
 	all_matches = name_matches + hp_matches + choice_matches
 	
 	# Sanity check the column identities as much as possible
@@ -169,91 +203,220 @@ def read_student_data(students_file_name, options_list):
 	assert len(hp_matches) == 1, "column id failure"
 	assert len(choice_matches) >= 1, "column id failure"
 	
-	# Extract student names and high priority info from the pandas dataframe
+	# Extract student names from the pandas dataframe
 	if len(name_matches) == 2:
 		n1, n2 = name_matches
-		names = list(zip(df[n1].tolist(), df[n2].tolist()))
+		names = [(str(first), str(last)) for first, last in
+			zip(df[n1].tolist(), df[n2].tolist())]
 	else:  # len(name_matches) == 1
-		names = df[name_matches[0]].tolist()
-	hps = df[hp_matches[0]].tolist()
+		names = [str(name) for name in df[name_matches[0]].tolist()]
 	
 	# Make sure that the student names are all unique
 	assert len(names) == len(set(names)), "student names must be unique"
 	
+	# Interpret the high priority marks in the spreadsheet all at once
+	hp_marks = {'yes': True, 'y': True, '1': True, 1: True,
+		'no': False, 'n': False, '0': False, 0: False}
+	hps = df[hp_matches[0]].map(hp_marks)
+	if hps.isna().any():
+		hp = df[hp_matches[0]][hps.isna()].iloc[0]
+		raise ValueError("unknown student high priority: {!r}".format(hp))
+	
 	# Extract the choice rank integers from the choice column headers
-	number_re = re.compile(r"\A[^\d]*(\d+)[^\d]*\Z")
 	n_choices = len(choice_matches)
-	ranks = [int(number_re.match(col).group(1)) for col in choice_matches]
+	ranks = [int(NUMBER_RE.match(col).group(1)) for col in choice_matches]
 	
 	# Check that all of the choices are ranked from 1 through n
-	assert set(ranks) == set(range(1, n_choices + 1)), "choice rank failure"
+	assert sorted(ranks) == list(range(1, n_choices + 1)), \
+		"choice rank failure"
 	
-	# Zip the choice columns together in descending order of preference
+	# Pull out the choice columns in descending order of preference
 	choice_columns = list()
 	for rank in range(1, n_choices + 1):
-		col = choice_matches[ranks.index(rank)]
-		choice_columns.append(df[col].tolist())
-	choices_rows = zip(*choice_columns)
-	
-	# Make the list of options into a set for convenience reasons
-	options_set = set(options_list)
-	
-	# Assemble the list of student objects that will be returned
-	students = list()
-	for name, hp, choices in zip(names, hps, choices_rows):
-		
-		# Interpret the high priority marks in the spreadsheet
-		if hp in {'yes', 'y', '1', 1}:
-			hp_TF = True
-		elif hp in {'no', 'n', '0', 0}:
-			hp_TF = False
-		else:
-			raise ValueError("unknown student high priority: {!r}".format(hp))
-		
-		# Make sure that the student's choices make sense
-		choices_set = set(choices)
-		assert len(choices_set) == n_choices, "ranked choices must be unique"
-		assert choices_set.issubset(options_set), \
-			"invalid student choices: {!r}".format(choices)
-		
-		# Construct student object and append to list
-		student = Student(name, hp_TF, choices)
-		students.append(student)
+		choice_columns.append(choice_matches[ranks.index(rank)])
+	choices_df = df[choice_columns]
+	
+	# Make sure that every student's choices make sense, all at once
+	valid = choices_df.isin(options_list).all(axis=1)
+	assert valid.all(), "invalid student choices: {!r}".format(
+		tuple(choices_df[~valid].iloc[0]))
+	assert (choices_df.nunique(axis=1) == n_choices).all(), \
+		"ranked choices must be unique"
+	
+	# Swap the choices for option indices, the algorithm only uses those
+	option_idx = {option: j for j, option in enumerate(options_list)}
+	choices_rows = choices_df.apply(lambda col: col.map(option_idx))
+	
+	# Assemble the parallel lists of student data that will be returned
+	choices = [tuple(row) for row in choices_rows.to_numpy().tolist()]
+	students = Students(names, hps.tolist(), choices)
 	
 	# Return the list that we've been working towards this whole time
 	return students, n_choices
 
-def recursive_assignment_algorithm(match, students, options, n_choices,
-	min_per_option, max_per_option, stage=1):
+def hungarian_assignment_algorithm(match, students, options, n_choices, rank,
+	min_per_option, max_per_option):
+	"""Find the best matching as a rank-maximal assignment problem, solved by
+	AlgorithmUtilities.rank_maximal_assignment(), which sets up the seats and
+	weights for scipy.optimize.linear_sum_assignment() (or solves one score
+	component at a time when the class is too big for the weights to stay
+	exact). Return the pairs and score just like the recursive algorithm does.
+	"""
+	
+	# The solver already works on option indices, just like we do
+	assigned = au.rank_maximal_assignment(students.choices,
+		students.high_priority, len(options), min_per_option, max_per_option)
+	pairs = list(enumerate(assigned))
+	
+	# Score the assignment the usual way, then leave the match how we found it
+	checkpoint = match.checkpoint()
+	match.assign_pairs(pairs)
+	score = score_assignment(match, students, options, n_choices, rank,
+		min_per_option, max_per_option)
+	match.rollback(checkpoint)
+	
+	return pairs, score
+
+def cpsat_assignment_algorithm(match, students, options, n_choices, rank,
+	min_per_option, max_per_option):
+	"""Find the best matching with the OR-Tools CP-SAT solver, using one
+	boolean variable per student-option pair and hard constraints for the min
+	and max per option. The score gets maximized lexicographically, one
+	component at a time, so no weights are needed that could overflow. Return
+	the pairs and score just like the other algorithms do.
+	"""
+	
+	# Only this algorithm needs OR-Tools, so don't make everyone install it
+	from ortools.sat.python import cp_model
+	
+	# Every student gets exactly one option, every option gets min to max
+	n_students, n_options = len(students.names), len(options)
+	model = cp_model.CpModel()
+	x = [[model.NewBoolVar("x_{:d}_{:d}".format(i, j))
+		for j in range(n_options)] for i in range(n_students)]
+	for i in range(n_students):
+		model.AddExactlyOne(x[i])
+	for j in range(n_options):
+		n_assigned = sum(x[i][j] for i in range(n_students))
+		model.AddLinearConstraint(n_assigned, min_per_option, max_per_option)
+	
+	# Write out each component of the score tuple in terms of the variables
+	# Only the options each student actually picked are worth anything
+	by_rank = [list() for r in range(n_choices)]
+	hp_by_rank = [list() for r in range(n_choices)]
+	for i, choices in enumerate(students.choices):
+		for r in range(n_choices):
+			by_rank[r].append(x[i][choices[r]])
+			if students.high_priority[i]:
+				hp_by_rank[r].append(x[i][choices[r]])
+	components = [sum(sum(picked) for picked in by_rank)]
+	components += [sum(picked) for picked in by_rank]
+	components += [sum(picked) for picked in hp_by_rank]
+	
+	# Maximize each component in turn, then hold it at its best value while
+	# the later components get their turn, starting from the last solution
+	solver = cp_model.CpSolver()
+	for component in components:
+		model.Maximize(component)
+		status = solver.Solve(model)
+		if status != cp_model.OPTIMAL:
+			raise RuntimeError("CP-SAT stopped with status {}".format(
+				solver.StatusName(status)))
+		model.Add(component == round(solver.ObjectiveValue()))
+		model.ClearHints()
+		for row in x:
+			for var in row:
+				model.AddHint(var, solver.Value(var))
+	
+	# Read the pairs back off the variables from the final solve
+	pairs = list()
+	for i in range(n_students):
+		for j in range(n_options):
+			if solver.Value(x[i][j]):
+				pairs.append((i, j))
+	
+	# Score the assignment the usual way, then leave the match how we found it
+	checkpoint = match.checkpoint()
+	match.assign_pairs(pairs)
+	score = score_assignment(match, students, options, n_choices, rank,
+		min_per_option, max_per_option)
+	match.rollback(checkpoint)
+	
+	return pairs, score
+
+def recursive_assignment_algorithm(match, students, options, n_choices, rank,
+	min_per_option, max_per_option, stage=1, memo=None):
 	""""""
 	
+	# Different trims often leave the same students unmatched with the same
+	# number of students in each option, and from there the rest of the search
+	# plays out the same way, so remember how the unmatched students got placed
+	# The memo only makes sense for one top-level call, so start a fresh one
+	if memo is None:
+		memo = {'borrowed': 0}
+	unmatched = match.list_unmatched_students()
+	state = (stage, frozenset(unmatched), match.get_option_counts())
+	if state in memo:
+		checkpoint = match.checkpoint()
+		match.assign_pairs(memo[state])
+		pairs = match.reduce_to_pairs()
+		score = score_assignment(match, students, options, n_choices, rank,
+			min_per_option, max_per_option)
+		match.rollback(checkpoint)
+		return pairs, score
+	
+	# The base case sometimes has to pull locked students out of their choices
+	# That depends on more than the state above, so anything that happens
+	# above such a base case can't be remembered
+	borrowed = memo['borrowed']
+	
 	# If there are no student choices remaining, then trigger the base case
 	if stage > n_choices:
-		return assignment_algorithm_base_case(match, students, options,
-			n_choices, min_per_option, max_per_option)
+		underfilled = match.list_underfilled_options(min_per_option)
+		if len(unmatched) < len(underfilled):
+			memo['borrowed'] += 1
+		best_match, best_score = assignment_algorithm_base_case(match,
+			students, options, n_choices, rank, min_per_option, max_per_option,
+			underfilled)
+		remember_assignment(memo, state, borrowed, unmatched, best_match)
+		return best_match, best_score
 	
 	# Otherwise, assign every unassigned student to their "stage-th" choice
-	assigned_students = list()
-	for student in students:
-		if not match.is_matched(student.get_name()):
-			match.assign(student.get_name(), student.get_choice(stage))
-			assigned_students.append(student.get_name())
+	# Remember where we started so all of this can be undone at the end
+	stage_checkpoint = match.checkpoint()
+	for i, choices in enumerate(students.choices):
+		if not match.is_matched(i):
+			match.assign(i, choices[stage - 1])
 	
 	# Find every option in the match that is now overfilled with students
 	overfilled = match.list_overfilled_options(max_per_option)
 	
 	# For each overfilled option, use an iterable to generate all the ways that
 	# students could be kicked out of the group to reduce it to the needed size
+	# Students with the same priority and the same choices left are as good as
+	# each other, so it doesn't matter which of them gets kicked out
+	# Try kicking out the regular students before the high priority ones, since
+	# those trims tend to score well and let us skip more of the others below
+	def trim_key(x):
+		return (students.high_priority[x], students.choices[x][stage:])
 	trim_iterables = list()
 	for option in overfilled:
-		trim_iterables.append(match.make_trim_iterable(option, max_per_option))
+		trims = list(match.make_trim_iterable(option, max_per_option,
+			trim_key))
+		trims.sort(key=lambda group:
+			sum(students.high_priority[x] for x in group))
+		trim_iterables.append(trims)
 	
 	# Combine the iterables together into one big Cartesian product iterable
 	# that hopefully isn't actually very big
 	if len(trim_iterables) > 0:
 		trim_product = it.product(*trim_iterables)
 	else:
-		trim_product = it.repeat(tuple(), n=1)  # Case with no overfull groups
+		trim_product = it.repeat(tuple(), 1)  # Case with no overfull groups
+	
+	# Score everything as it stands, the trims can only take away from this
+	stage_score = score_assignment(match, students, options, n_choices, rank,
+		min_per_option, max_per_option)
 	
 	# Initialize variables to store the best matching and its associated score
 	best_match, best_score = None, None
@@ -262,53 +425,73 @@ def recursive_assignment_algorithm(match, students, options, n_choices,
 	for trim in trim_product:
 		
 		# Use the trimming option to remove pairings from the match object
-		# Save all the removed pairings so we can restore them later
-		saved_pairs = list()
+		# The checkpoint lets us put them all back again afterwards
+		trim_checkpoint = match.checkpoint()
 		for group in trim:
 			for student in group:
-				saved_pairs.append((student, match.get_match(student)))
 				match.erase(student)
 		
-		# Recurse this same function to the next stage of choices
-		# Lock any work we've done so the other stages can't mess with it
-		locked_students = match.lock_all_matched()
-		new_match, new_score = recursive_assignment_algorithm(match, students,
-			options, n_choices, min_per_option, max_per_option, stage + 1)
-		match.unlock_many(locked_students)
-		
-		# Compare the returned match from the recursion, save it if warranted
-		if best_score is None or new_score > best_score:
-			best_match = new_match
-			best_score = new_score
+		# Skip this trim if even the best case can't beat what we already have
+		upper_bound = score_upper_bound(match, stage_score, trim, students,
+			n_choices, max_per_option, stage)
+		if best_score is None or upper_bound > best_score:
+			
+			# Recurse this same function to the next stage of choices
+			# Lock any work we've done so the other stages can't mess with it
+			locked_students = match.lock_all_matched()
+			new_match, new_score = recursive_assignment_algorithm(match,
+				students, options, n_choices, rank, min_per_option,
+				max_per_option, stage + 1, memo)
+			match.unlock_many(locked_students)
+			
+			# Compare the returned match from the recursion, save it if it wins
+			if best_score is None or new_score > best_score:
+				best_match = new_match
+				best_score = new_score
 		
 		# Restore all the pairings that were removed from the match object
-		match.assign_pairs(saved_pairs)
+		match.rollback(trim_checkpoint)
 	
 	# Clean up any assignments we made here before returning
-	match.erase_many(assigned_students)
+	match.rollback(stage_checkpoint)
 	
 	# Return the best we've found so far to the previous layer of recursion
+	remember_assignment(memo, state, borrowed, unmatched, best_match)
 	return best_match, best_score
 
-def assignment_algorithm_base_case(match, students, options, n_choices,
-	min_per_option, max_per_option):
+def remember_assignment(memo, state, borrowed, unmatched, pairs):
+	"""Save the options given to the unmatched students in the memo under the
+	given state, unless a base case had to borrow locked students since then.
+	"""
+	
+	if memo['borrowed'] == borrowed and pairs is not None:
+		unmatched = set(unmatched)
+		memo[state] = [pair for pair in pairs if pair[0] in unmatched]
+
+def assignment_algorithm_base_case(match, students, options, n_choices, rank,
+	min_per_option, max_per_option, underfilled=None):
 	""""""
 	
 	# Determine how many unhappy students there are in this matching
 	n_unhappy = match.get_n_unmatched()
 	
 	# Identify any unfilled spaces that need to be filled to finish the match
-	underfilled = match.list_underfilled_options(min_per_option)
+	# (the recursion has usually listed them already, so it can pass them in)
+	if underfilled is None:
+		underfilled = match.list_underfilled_options(min_per_option)
+	
+	# Everything we change from here on gets rolled back before returning
+	checkpoint = match.checkpoint()
 	
 	# Create even more unhappy students to fill the empty spaces if necessary
+	borrowed = list()
 	if n_unhappy < len(underfilled):
 		unhappy_queue = find_more_unhappy_students(match, students, options,
-			n_choices, min_per_option, max_per_option)
-		for i in range(len(underfilled) - n_unhappy):
-			match.unlock(unhappy_queue[i])
-			unhappy_queue[i] = (unhappy_queue[i],
-				match.get_match(unhappy_queue[i]))
-			match.erase(unhappy_queue[i][0])
+			n_choices, rank, min_per_option, max_per_option)
+		borrowed = unhappy_queue[:len(underfilled) - n_unhappy]
+		for student in borrowed:
+			match.unlock(student)
+			match.erase(student)
 	
 	# Assign all the unhappy students to the spaces that need filling
 	unhappy = match.list_unmatched_students()
@@ -325,165 +508,203 @@ def assignment_algorithm_base_case(match, students, options, n_choices,
 			match.assign(unhappy[i], empty_spots[j])
 	
 	# Score the resulting assignment of students
-	score = score_assignment(match, students, options, n_choices,
+	score = score_assignment(match, students, options, n_choices, rank,
 		min_per_option, max_per_option)
 	
 	# Reduce the assignment of students to a list of pairs for later
 	pairs = match.reduce_to_pairs()
 	
-	# Remove all of the assignments given to the unhappy students
-	match.erase_many(unhappy)
-	
-	# Restore any unhappy students that needed to be created to fill spots
-	if n_unhappy < len(underfilled):
-		for i in range(len(underfilled) - n_unhappy):
-			match.assign(unhappy_queue[i][0], unhappy_queue[i][1])
-			match.lock(unhappy_queue[i][0])
+	# Remove all of the assignments given to the unhappy students, and restore
+	# any unhappy students that needed to be created to fill spots
+	match.rollback(checkpoint)
+	for student in borrowed:
+		match.lock(student)
 	
 	# Return the assignment of students (as a list of pairs) and its score
 	return pairs, score
 
-def find_more_unhappy_students(match, students, options, n_choices,
+def find_more_unhappy_students(match, students, options, n_choices, rank,
 	min_per_option, max_per_option):
 	""""""
 	
 	happiness = dict()
 	priority = dict()
-	for student in students:
-		assigned = match.get_match(student.get_name())
-		priority[student.get_name()] = int(student.is_high_priority())
-		happiness[student.get_name()] = 0
-		for i in range(1, n_choices + 1):
-			if student.get_choice(i) == assigned:
-				happiness[student.get_name()] = n_choices - i + 1
-				break
+	for s, hp in enumerate(students.high_priority):
+		priority[s] = int(hp)
+		got = rank[s][match.get_match(s)]
+		happiness[s] = n_choices - got + 1 if got > 0 else 0
 	
+	# One shuffle for the tie breaks, then one sort on the whole key at once
 	tiers = dict()
-	for option in options:
-		option_students = match.list_students_by_option(option)
+	for option in range(len(options)):
+		option_students = match.list_students_for_option(option)
 		random.shuffle(option_students)
-		option_students.sort(key=lambda x: happiness[x])
-		option_students.sort(key=lambda x: priority[x], reverse=True)
+		option_students.sort(key=lambda x: (-priority[x], happiness[x]))
 		for i in range(len(option_students)):
 			tiers[option_students[i]] = i + 1
 	
 	queue = [student for student in happiness.keys() if happiness[student] > 0]
 	random.shuffle(queue)
-	queue.sort(key=lambda x: happiness[x], reverse=True)
-	queue.sort(key=lambda x: tiers[x], reverse=True)
+	queue.sort(key=lambda x: (-tiers[x], -happiness[x]))
 	
 	return queue
 
-def score_assignment(match, students, options, n_choices, min_per_option,
+def score_assignment(match, students, options, n_choices, rank, min_per_option,
 	max_per_option):
 	"""Score the optimality of a particular match based on number of happy
 	students, number of 1st choices, 2nd choices, ..., high priority 1st
 	choices, high priority 2nd choices, ...
 	"""
 	
-	score = [0] + [0] * (2 * n_choices)
+	# Tally up how many students got each rank, with unhappy ones at rank 0
+	# This gets called at every step of the recursion, so keep it a tight loop
+	counts = [0] * (n_choices + 1)
+	hp_counts = [0] * (n_choices + 1)
+	for row, option, hp in zip(rank, match.get_matches(),
+		students.high_priority):
+		i = row[option]
+		counts[i] += 1
+		if hp:
+			hp_counts[i] += 1
+	
+	n_happy = len(students.names) - counts[0]
+	return (n_happy,) + tuple(counts[1:]) + tuple(hp_counts[1:])
+
+def make_rank_table(students, n_options, n_choices):
+	"""Return a table where rank[s][o] is the rank that student s gave option
+	o, or 0 if they didn't pick it. There is an extra column of zeros at the
+	end, so that looking up an unmatched student (option -1) gives 0 too.
+	"""
 	
-	for student in students:
-		assigned = match.get_match(student.get_name())
+	rank = list()
+	for choices in students.choices:
+		row = [0] * (n_options + 1)
 		for i in range(1, n_choices + 1):
-			if student.get_choice(i) == assigned:
-				score[0] += 1
-				score[i] += 1
-				if student.is_high_priority():
-					score[n_choices + i] += 1
-				break
+			row[choices[i - 1]] = i
+		rank.append(row)
 	
-	return tuple(score)
-
-# CLASSES
-###########
+	return rank
 
-class Student:
-	"""Simple data class representing a student. A student has a name, a high
-	priority flag, and a tuple listing their project choices.
+def sort_students_for_search(students, n_options):
+	"""Return a copy of the students data with the high priority students
+	first, then the students whose most popular choice is the most in demand.
+	Also return the list of original indices, so order[s] is the index that
+	student s of the copy has in the original students data.
 	"""
 	
-	def __init__(self, name, high_priority, choices):
-		"""Create a new student object. Name can be a string or sequence of
-		strings, high_priority is a boolean flag, and choices is a sequence of
-		unique strings from the available project options.
-		"""
-		
-		# Handle either permissible type for the name argument
-		if type(name) == type(""):
-			self.name = str(name)
-		else:
-			self.name = tuple(str(part) for part in name)
-		
-		# Save the other two arguments, ensuring they have the correct types
-		self.high_priority = bool(high_priority)
-		self.choices = tuple(str(choice) for choice in choices)
+	# Count how many students listed each option as any of their choices
+	demand = [0] * n_options
+	for choices in students.choices:
+		for option in choices:
+			demand[option] += 1
 	
-	def n_choices(self):
-		"""Return the number of top choices that this student has."""
-		
-		pass
-		#return len(self.choices)
+	order = sorted(range(len(students.names)), key=lambda s:
+		(not students.high_priority[s],
+		-max(demand[option] for option in students.choices[s])))
 	
-	def get_name(self):
-		"""Return the student's name string or name tuple."""
-		
-		return self.name
+	reordered = Students([students.names[s] for s in order],
+		[students.high_priority[s] for s in order],
+		[students.choices[s] for s in order])
+	return reordered, order
+
+def score_upper_bound(match, stage_score, trim, students, n_choices,
+	max_per_option, stage):
+	"""Return a score that no matching reachable after this trim can beat.
+	Start from the score before the trim, then pretend each trimmed student
+	gets the next choice of theirs that isn't already full. Full options stay
+	full for the rest of the recursion, since everyone in them gets locked.
+	"""
 	
-	def get_choice(self, rank):
-		"""Return the student's nth ranked choice (use one-based indexing)."""
-		
-		return self.choices[rank - 1]
+	score = list(stage_score)
+	for group in trim:
+		for i in group:
+			
+			# Take back the choice that the student just got trimmed from
+			hp = students.high_priority[i]
+			score[stage] -= 1
+			if hp:
+				score[n_choices + stage] -= 1
+			
+			# Look for the best choice they could still possibly get
+			for rank in range(stage + 1, n_choices + 1):
+				option = students.choices[i][rank - 1]
+				if match.count_students_for_option(option) < max_per_option:
+					score[rank] += 1
+					if hp:
+						score[n_choices + rank] += 1
+					break
+			else:
+				score[0] -= 1  # Nothing left, they're going to be unhappy
 	
-	def is_high_priority(self):
-		"""Return whether the student is flagged as high priority."""
-		
-		return self.high_priority
+	return tuple(score)
+
+# CLASSES
+###########
+
+class Students(collections.namedtuple('Students',
+	['names', 'high_priority', 'choices'])):
+	"""Simple data class representing the whole class of students, stored as
+	three parallel lists: each student's name (a string or tuple of strings),
+	high priority flag, and tuple of choices (as option indices, in order).
+	Student s is just index s into all three lists.
+	"""
+	
+	__slots__ = ()
 
 class Matching:
 	"""Class representing a mutable matching between students and options that
 	the algorithm can tinker with as it works."""
 	
 	def __init__(self, students, options):
-		"""Given a list of student objects and a list of options, set up two
-		inner dict objects that will drive a new matching instance, along with
-		other needed internal machinery.
+		"""Given the students data and a list of options, set up two
+		inner lists that will drive a new matching instance, along with other
+		needed internal machinery. Students and options are referred to by
+		their indices in those two lists, never by name.
 		"""
 		
-		# Set up the dict organized by student name
-		self.by_student = dict()
-		for student in students:
-			self.by_student[student.get_name()] = None
-		assert len(self.by_student) == len(students)
+		# Set up the list organized by student index (-1 means unmatched)
+		self.by_student = [-1] * len(students.names)
 		
-		# Set up the dict organized by option
-		self.by_option = dict()
-		for option in options:
-			self.by_option[option] = set()
-		assert len(self.by_option) == len(options)
+		# Set up the list of student index sets organized by option index
+		self.by_option = [set() for option in options]
 		
-		# Set up the dict to keep track of whether students are "locked"
+		# Set up the list to keep track of whether students are "locked"
 		# Locked students cannot have their match changed
-		self.student_locked = dict()
-		for student in self.by_student.keys():
-			self.student_locked[student] = False
+		self.student_locked = [False] * len(students.names)
+		
+		# Keep track of who is unmatched and how full each option is as we go,
+		# so the algorithm doesn't have to keep counting them up from scratch
+		self.unmatched = set(range(len(students.names)))
+		self.option_counts = [0] * len(options)
+		
+		# Same goes for who is matched but not locked yet, since the recursion
+		# locks exactly those students at every single stage
+		self.unlocked_matched = set()
+		
+		# Journal of every assign and erase, so they can be undone quickly
+		# Each entry is a (student, option, was_assigned) tuple
+		self.journal = list()
 	
 	def assign(self, student, option):
-		"""Match the named student with the named option. If the student is
+		"""Match the given student with the given option. If the student is
 		already matched, raise an error."""
 		
 		assert not self.is_matched(student)
 		assert not self.is_locked(student)
 		self.by_option[option].add(student)
 		self.by_student[student] = option
+		self.unmatched.discard(student)
+		self.unlocked_matched.add(student)
+		self.option_counts[option] += 1
+		self.journal.append((student, option, True))
 	
 	def get_match(self, student):
-		"""Return the option matched to the given student, if any."""
+		"""Return the option matched to the given student, or -1 if none."""
 		
 		return self.by_student[student]
 	
 	def erase(self, student):
-		"""Unmatch the named student from whatever option they are matched to.
+		"""Unmatch the given student from whatever option they are matched to.
 		Raise an error if the student is already unmatched.
 		"""
 		
@@ -491,58 +712,97 @@ class Matching:
 		assert not self.is_locked(student)
 		option = self.by_student[student]
 		self.by_option[option].remove(student)
-		self.by_student[student] = None
+		self.by_student[student] = -1
+		self.unmatched.add(student)
+		self.unlocked_matched.discard(student)
+		self.option_counts[option] -= 1
+		self.journal.append((student, option, False))
+	
+	def checkpoint(self):
+		"""Return a checkpoint that rollback() can later return the matching
+		to. Locking and unlocking students are not undone by rollback(), so
+		those need to be balanced out between the two calls.
+		"""
+		
+		return len(self.journal)
+	
+	def rollback(self, checkpoint):
+		"""Undo every assign and erase made since the given checkpoint, most
+		recent first. These were all checked the first time around, so the
+		undoing skips the checks and works on the internals directly.
+		"""
+		
+		while len(self.journal) > checkpoint:
+			student, option, was_assigned = self.journal.pop()
+			if was_assigned:
+				self.by_option[option].remove(student)
+				self.by_student[student] = -1
+				self.unmatched.add(student)
+				self.unlocked_matched.discard(student)
+				self.option_counts[option] -= 1
+			else:
+				self.by_option[option].add(student)
+				self.by_student[student] = option
+				self.unmatched.discard(student)
+				self.unlocked_matched.add(student)
+				self.option_counts[option] += 1
 	
 	def lock(self, student):
-		"""Lock the named student, making their match immutable for now."""
+		"""Lock the given student, making their match immutable for now."""
 		
 		assert not self.is_locked(student)
 		self.student_locked[student] = True
+		self.unlocked_matched.discard(student)
 	
 	def unlock(self, student):
-		"""Unlock the named student, making their match mutable again."""
+		"""Unlock the given student, making their match mutable again."""
 		
 		assert self.is_locked(student)
 		self.student_locked[student] = False
+		if self.is_matched(student):
+			self.unlocked_matched.add(student)
 	
 	def is_locked(self, student):
-		"""Return whether the named student is currently locked."""
+		"""Return whether the given student is currently locked."""
 		
 		return self.student_locked[student]
 	
 	def is_matched(self, student):
-		"""Return whether the student named has been matched to an option."""
+		"""Return whether the given student has been matched to an option."""
 		
-		return self.by_student[student] is not None
+		return self.by_student[student] != -1
+	
+	def get_matches(self):
+		"""Return a tuple with the option matched to each student, in student
+		order, with -1 for anyone unmatched.
+		"""
+		
+		return tuple(self.by_student)
 	
 	def get_n_unmatched(self):
 		"""Return the number of students who are not currently matched."""
 		
-		total = 0
-		for student in self.by_student.keys():
-			if not self.is_matched(student):
-				total += 1
-		return total
+		return len(self.unmatched)
 	
 	def list_unmatched_students(self):
 		"""Return a list of students who are not matched."""
 		
-		unmatched = list()
-		for student in self.by_student.keys():
-			if not self.is_matched(student):
-				unmatched.append(student)
-		return unmatched
+		return list(self.unmatched)
+	
+	def get_option_counts(self):
+		"""Return a tuple with the number of students matched to each option,
+		in the same order as the options list this matching was made with.
+		"""
+		
+		return tuple(self.option_counts)
 	
 	def reduce_to_pairs(self):
 		"""Return a new list of student-option tuples summarizing the matching
 		stored in this instance.
 		"""
 		
-		pairs = list()
-		for student in self.by_student.keys():
-			assert self.is_matched(student)
-			pairs.append((student, self.by_student[student]))
-		return pairs
+		assert len(self.unmatched) == 0
+		return list(enumerate(self.by_student))
 	
 	def assign_pairs(self, student_option_pairs):
 		"""Add several pairs to the matching. The input should be a sequence of
@@ -551,16 +811,10 @@ class Matching:
 		for student, option in student_option_pairs:
 			self.assign(student, option)
 	
-	def erase_many(self, students):
-		"""Given a sequence of student names, unmatch all of them."""
-		
-		for student in students:
-			self.erase(student)
-	
 	def erase_all(self):
 		"""Unmatch every matched student."""
 		
-		for student in self.by_student.keys():
+		for student in range(len(self.by_student)):
 			if self.is_matched(student):
 				self.erase(student)
 	
@@ -569,15 +823,14 @@ class Matching:
 		list of all the students who were locked by this call.
 		"""
 		
-		were_locked = list()
-		for student in self.by_student.keys():
-			if self.is_matched(student) and not self.is_locked(student):
-				self.lock(student)
-				were_locked.append(student)
+		were_locked = list(self.unlocked_matched)
+		for student in were_locked:
+			self.student_locked[student] = True
+		self.unlocked_matched.clear()
 		return were_locked
 	
 	def unlock_many(self, students):
-		"""Unlock every named student on the given list."""
+		"""Unlock every student on the given list."""
 		
 		for student in students:
 			self.unlock(student)
@@ -588,20 +841,22 @@ class Matching:
 		"""
 		
 		overfilled = list()
-		for option in self.by_option.keys():
-			if len(self.by_option[option]) > threshold:
+		for option, count in enumerate(self.option_counts):
+			if count > threshold:
 				overfilled.append(option)
 		return overfilled
 	
-	def make_trim_iterable(self, option, threshold):
+	def make_trim_iterable(self, option, threshold, key=None):
 		"""Return an iterator over every possible combination of unlocked
 		students who can be removed from their matches with the given option in
 		order to bring the option down to the provided threshold number of
-		matched students.
+		matched students. If a key function is given, students with the same
+		key are treated as interchangeable, and only one of the combinations
+		that differ just by swapping such students is included.
 		"""
 		
 		# Make sure it actually is overfilled first
-		n_assigned = len(self.by_option[option])
+		n_assigned = self.option_counts[option]
 		assert n_assigned > threshold
 		
 		removable = list()
@@ -609,7 +864,21 @@ class Matching:
 			if not self.is_locked(student):
 				removable.append(student)
 		
-		return it.combinations(removable, n_assigned - threshold)
+		if key is None:
+			return it.combinations(removable, n_assigned - threshold)
+		
+		# Line up interchangeable students next to each other, then only keep
+		# the combinations that take each group's students from the front
+		removable.sort(key=key)
+		keys = [key(student) for student in removable]
+		trims = list()
+		n_trim = n_assigned - threshold
+		for combo in it.combinations(range(len(removable)), n_trim):
+			chosen = set(combo)
+			if all(i == 0 or keys[i - 1] != keys[i] or i - 1 in chosen
+				for i in combo):
+				trims.append(tuple(removable[i] for i in combo))
+		return trims
 	
 	def list_underfilled_options(self, threshold):
 		"""Return a list of every option in the match which has fewer than
@@ -618,10 +887,9 @@ class Matching:
 		it requires two students, and so on."""
 		
 		underfilled = list()
-		for option in self.by_option.keys():
-			if len(self.by_option[option]) < threshold:
-				for i in range(threshold - len(self.by_option[option])):
-					underfilled.append(option)
+		for option, count in enumerate(self.option_counts):
+			if count < threshold:
+				underfilled.extend([option] * (threshold - count))
 		return underfilled
 	
 	def list_empty_spots(self, low_threshold, high_threshold):
@@ -631,44 +899,42 @@ class Matching:
 		high_theshold - 2 matches, and so on."""
 		
 		empty_spots = list()
-		for option in self.by_option.keys():
-			if low_threshold <= len(self.by_option[option]) < high_threshold:
-				for i in range(high_threshold - len(self.by_option[option])):
-					empty_spots.append(option)
+		for option, count in enumerate(self.option_counts):
+			if low_threshold <= count < high_threshold:
+				empty_spots.extend([option] * (high_threshold - count))
 		return empty_spots
 	
+	def count_students_for_option(self, option):
+		"""Return the number of students matched to the given option."""
+		
+		return self.option_counts[option]
+	
 	def list_students_for_option(self, option):
-		"""Given one option, return a list of all student names matched to that
+		"""Given one option, return a list of all students matched to that
 		option.
 		"""
 		
 		return list(self.by_option[option])
 	
-	def pretty_print_in_order(self, options_order, students, n_choices):
+	def pretty_print_in_order(self, options_order, students, rank):
 		"""Pretty print the matching by option category, adhering to the order
-		set by the option order list. Also document students' choices.
+		set by the option order list. Also document students' choices. This is
+		the only place where the student and option names come back in.
 		"""
 		
-		got_choice = dict()
-		high_priority = dict()
-		for student in students:
-			assigned = self.get_match(student.get_name())
-			high_priority[student.get_name()] = student.is_high_priority()
-			got_choice[student.get_name()] = None
-			for i in range(1, n_choices + 1):
-				if student.get_choice(i) == assigned:
-					got_choice[student.get_name()] = i
-					break
-		
-		for option in options_order:
-			print('  ' + option)
+		# Everything we need is already in the students data and rank table
+		for option, option_name in enumerate(options_order):
+			print('  ' + option_name)
 			student_list = self.list_students_for_option(option)
-			student_list.sort()
+			student_list.sort(key=lambda i: students.names[i])
 			for student in student_list:
-				ch_str = 'choice #{:d}'.format(got_choice[student]) if \
-					got_choice[student] is not None else 'unhappy'
-				hp_str = ', high priority' if high_priority[student] else ''
-				print('    {!s} ({:s}{:s})'.format(student, ch_str, hp_str))
+				name = students.names[student]
+				got_choice = rank[student][option]
+				ch_str = 'choice #{:d}'.format(got_choice) if got_choice > 0 \
+					else 'unhappy'
+				hp_str = ', high priority' if students.high_priority[student] \
+					else ''
+				print('    {!s} ({:s}{:s})'.format(name, ch_str, hp_str))
 
 # CALL TO MAIN
 ################
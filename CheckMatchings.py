@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Check the fast rank_maximal_matching() against the brute-force search
+# The brute-force MatchingsIterator tries every permitted matching, which is
+# hopeless for a real class, but fine for lots of small random fake classes
+# Both should always agree on the best score, for any min and max per option
+
+import random
+
+import AlgorithmUtilities as au
+
+# Randomization parameters to use
+N_TRIALS = 300
+MAX_STUDENTS = 8
+MAX_OPTIONS = 5
+MAX_CHOICES = 3
+random.seed(1221)  # For reproducible results
+
+n_checked = 0
+for trial in range(N_TRIALS):
+
+	# Make up a small class, skipping limits that no matching could satisfy
+	n_students = random.randint(2, MAX_STUDENTS)
+	n_options = random.randint(2, MAX_OPTIONS)
+	n_choices = random.randint(1, min(MAX_CHOICES, n_options))
+	min_per_option = random.randint(0, 1)
+	max_per_option = random.randint(2, 3)
+	if not n_options * min_per_option <= n_students \
+		<= n_options * max_per_option:
+		continue
+
+	options = ["Option {:d}".format(j + 1) for j in range(n_options)]
+	choices, high_priority = dict(), dict()
+	for i in range(n_students):
+		name = "Student {:d}".format(i + 1)
+		choices[name] = random.sample(options, n_choices)
+		high_priority[name] = random.random() < 0.3
+
+	# Score the fast answer and the brute-force answers the same way
+	scorer = au.ScoreCalculator(choices, high_priority)
+	fast_match = au.rank_maximal_matching(options, choices, high_priority,
+		min_per_option, max_per_option)
+	fast_score = scorer.calculate_score(fast_match)
+	iterator = au.MatchingsIterator(options, choices, min_per_option,
+		max_per_option)
+	brute_score, brute_matches = iterator.find_best(scorer)
+
+	assert fast_match.obeys_min_per_option(min_per_option)
+	assert fast_match.obeys_max_per_option(max_per_option)
+	assert fast_score == brute_score, "mismatch on trial {:d}".format(trial)
+	n_checked += 1
+
+print("Both algorithms agreed on all", n_checked, "random classes")
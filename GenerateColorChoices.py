@@ -8,6 +8,8 @@
 # Last modified 29 Nov 2020 by Greg Vance
 
 import random
+import csv
+import numpy as np
 
 # Preset values for input/output files
 NAME_FILES = ["BoyNames.txt", "GirlNames.txt"]
@@ -25,20 +27,13 @@ random.seed(9121)  # For reproducible results
 all_names = set()
 for file_name in NAME_FILES:
 	with open(file_name, "r") as name_f:
-		for line in name_f:
-			cleaned = line.strip()
-			if cleaned:
-				all_names.add(cleaned)
+		all_names.update(filter(None, map(str.strip, name_f)))
 all_names = list(all_names)
 all_names.sort()  # Unsorted defeats the point of the random seed
 
 # Read in the list of colors that the students can choose from
-colors = set()
 with open(COLOR_FILE, "r") as color_f:
-	for line in color_f:
-		cleaned = line.strip()
-		if cleaned:
-			colors.add(cleaned)
+	colors = set(filter(None, map(str.strip, color_f)))
 colors = list(colors)
 colors.sort()  # Unsorted defeats the point of the random seed
 N_COLORS = len(colors)  # Could specify above as a randomization parameter...
@@ -50,13 +45,11 @@ names.sort()  # Might as well alphabetize them
 
 # Try to replicate the reality of some options being more popular than others
 # We'll use a Zipf's Law distribution for the popularity of color options
-zipf = [1. / (n + 1) for n in range(N_COLORS)]
-norm = 1. / sum(zipf)
-prob = [p * norm for p in zipf]
-random.shuffle(prob)  # In-place shuffle
-cumulative = [sum(prob[:i+1]) for i in range(N_COLORS)]
-c_norm = 1. / cumulative[-1]
-cumulative = [c * c_norm for c in cumulative]  # Just to make sure
+zipf = 1. / (np.arange(N_COLORS) + 1)
+prob = zipf / zipf.sum()
+random.shuffle(prob)  # In-place shuffle, same random stream as for a list
+cumulative = np.cumsum(prob)
+cumulative /= cumulative[-1]  # Just to make sure
 assert cumulative[-1] == 1.0
 
 # Write a function that uses the cumulative probabilities to select k choices
@@ -64,9 +57,7 @@ def select_choices(items, c_prob, k):
 	choices = list()
 	while len(choices) < k:
 		r = random.random()
-		i = 0
-		while c_prob[i] <= r:
-			i += 1
+		i = np.searchsorted(c_prob, r, side="right")  # First c_prob[i] > r
 		if items[i] not in choices:
 			choices.append(items[i])
 	return choices
@@ -84,16 +75,18 @@ high_priority = ["yes"] * N_HIGH_PRIORITY + ["no"] * delta_n
 random.shuffle(high_priority)  # In-place shuffle
 
 # Put the data into the desired output file
-with open(OUTPUT_FILE, "w") as out_f:
+# The csv module will also quote any names that happen to have commas in them
+with open(OUTPUT_FILE, "w", newline="") as out_f:
 	headers = ["Student Name", "High Priority"]
 	for n in range(N_CHOICES):
 		headers.append("Choice {:d}".format(n + 1))
-	header = ','.join(headers) + '\n'
-	out_f.write(header)
+	rows = list()
 	for i in range(N_STUDENTS):
 		columns = [names[i], high_priority[i]]
 		columns.extend(choices[i])
-		row = ','.join(columns) +'\n'
-		out_f.write(row)
+		rows.append(columns)
+	writer = csv.writer(out_f, lineterminator="\n")
+	writer.writerow(headers)
+	writer.writerows(rows)
 
 